@@ -1,31 +1,42 @@
 import re
+import uuid
 
-import models, logging, yaml, enum, parsers, collections, threading, time, triage, matching.match_users
+import models, logging, yaml, enum, types, functools, parsers, collections, queue, threading, triage, matching.match_users, asyncio, contextlib, itertools
+import concurrent.futures
+import httpx
 from flask import Flask, make_response, render_template, redirect, url_for, request, session
-from twilio.rest import Client
 from twilio.twiml.messaging_response import MessagingResponse
 from waitress import serve
-import sys
 
 
 application = Flask(__name__)
 application.config.from_object(__name__)
 
 # user model repo (models.py) is responsible for managing response behavior of users
-user_model_repo = models.UserModelRepository(parsers.response_model_from_yaml_file('schema.yaml'), logging.getLogger(str(__name__)))
+logger = logging.getLogger(str(__name__))
+user_model_repo = models.UserModelRepository(parsers.response_model_from_yaml_file('schema.yaml'), logger)
 # user_queue is a dequeue of 'user' objects (each user object has phone number ('uuid') and dict w/ symptom info ('user_vals'))
 user_queue = collections.deque()
-# to_response_queue is a dequeue of 'user' objects who have already been triaged, but need to be matched to nearby medical centers
-to_respond_queue = collections.deque()
+# to_response_queue is a queue of 'user' objects who have already been triaged, but need to be matched to nearby medical centers
+# (queue.Queue blocks the SMS dispatcher until work arrives; the dispatcher is only started when this file is run
+# directly, so deploy with `python application.py` as described in the README rather than a separate WSGI server)
+to_respond_queue = queue.Queue()
 lock = threading.RLock()
-work_available_condition = threading.Condition(lock)
+# active_assignments maps each web app user (by the 'doctor_id' in their session) to the user they are triaging;
+# kept server-side and guarded by lock, so that two requests can never claim the same user
+active_assignments = {}
 
 # configuration.yml contains:
 #   Twilio credentials (acct SID, token, phone #, message service ID) 
 #   Flask config variables (secret key for session, host, port, debug bool)
 #   Zipcode radius (in km)
 # See example_configuration.yml
-config = yaml.safe_load(open('./configuration.yml'))
+@functools.lru_cache(maxsize=None)
+def load_config(filename='./configuration.yml'):
+    with open(filename, 'rb') as f:
+        return yaml.load(f, Loader=parsers.yaml_loader)
+
+config = load_config()
 twilio_acct_sid = config['twilio']['acct_sid']
 twilio_token = config['twilio']['token']
 twilio_number = config['twilio']['number']
@@ -35,8 +46,49 @@ application.secret_key = config['flask']['secret_key']
 
 zip_code_radius = int(config['zipcodeapi']['radius_km'])
 
-# Twilio client (used to send messages)
-client = Client(twilio_acct_sid, twilio_token)
+# Twilio REST API for this account (messages are posted to it directly by the SMS dispatcher)
+twilio_api_url = f'https://api.twilio.com/2010-04-01/Accounts/{twilio_acct_sid}'
+# maximum number of users whose messages are sent concurrently by the SMS dispatcher
+sms_max_in_flight = 32
+# attempts at looking up a user's hospitals before sending them the triage advice without a hospital list
+hospital_lookup_attempts = 5
+# seconds an idle connection to Twilio is kept open, so bursts of messages minutes apart
+# skip the TCP/TLS handshake (httpx closes idle connections after 5 seconds by default)
+twilio_keepalive_seconds = 120
+# number of Twilio clients (each with its own connection) the SMS dispatcher spreads sends over
+twilio_client_pool_size = 8
+# threads for the (blocking) hospital lookups behind each message, one per user the dispatcher has in flight
+hospital_lookup_executor = concurrent.futures.ThreadPoolExecutor(max_workers=sms_max_in_flight,
+                                                                 thread_name_prefix='hospital-lookup')
+# threads for speculatively fetching a user's hospitals as soon as they text their zip code, so the
+# records are usually ready (and cached) by the time a doctor has triaged them
+hospital_prefetch_executor = concurrent.futures.ThreadPoolExecutor(max_workers=8,
+                                                                   thread_name_prefix='hospital-prefetch')
+
+# matches a (case-insensitive) 'RESTART' text, compiled once rather than upper-casing every message
+is_restart_message = re.compile(r'^\s*RESTART\s*$', re.IGNORECASE).match
+
+# message and whether to match hospitals, by triage code (built once; read-only)
+# TODO: improve response messages
+triage_responses = types.MappingProxyType({
+    "home": ("Stay at home, rest, and take medication as necessary", False),
+    "LEVEL 1": ("Please seek Triage Level 1 assistance; you will be provided with a list of nearby hospitals/clinics:", True),
+    "LEVEL 2": ("Please seek Triage Level 2 assistance; you will be provided with a list of nearby hospitals/clinics:", True),
+    "LEVEL 3": ("Please seek Triage Level 3 assistance; you will be provided with a list of nearby hospitals/clinics:", True),
+    "LEVEL 4": ("Please seek Triage Level 4 assistance; you will be provided with a list of nearby hospitals/clinics:", True),
+    "gettest": ("Please get tested for COVID-19; you will be provided with a list of nearby testing locations:", False),
+    "checkinlater8": ("Please stay put and text back in 8 hours", False),
+    "checkinlater16": ("Please stay put and text back in 16 hours", False),
+    "checkinlater24": ("Please stay put and text back in 24 hours", False),
+})
+
+# how each selected hospital is listed in the SMS (fields are from the hospital record's attributes)
+hospital_message_format = '{NAME} \n {ADDRESS} \n {CITY}, {STATE}  {ZIP}\n\n'
+
+# hospital choice probabilities (from the match weights) by (zip code, triage code, hospital ids, cache period),
+# since zip codes and triage codes repeat across a shift; entries expire with the hospital records they were
+# computed from (which are cached by triage.get_hospital_records_within_distance)
+hospital_choice_cache = {}
 
 # home page (option to either upload/update hospital resource data or triage patients)
 @application.route('/')
@@ -51,16 +103,19 @@ def resources():
 # page for triaging patients
 @application.route('/triage')
 def triaging():
-    # if there are patients in the queue or the session
-    # (there will be a patient in the session if they were being served by the current
+    if 'doctor_id' not in session:
+        session['doctor_id'] = str(uuid.uuid4())
+    doctor_id = session['doctor_id']
+    # take the next patient from the queue, unless one is already assigned to this web app user
+    # (there will be an assigned patient if they were being served by the current
     # web app user, but the web app user refreshed/left and revisted the site) 
-    if len(user_queue) > 0 or ('user_uuid' in session and session['user_uuid'] != None):
-        if 'user_uuid' not in session or session['user_uuid'] == None:
-            user = user_queue.popleft()
-            session['user_uuid'] = user.uuid
-            session['user_vals'] = user.values
+    with lock:
+        if doctor_id not in active_assignments and len(user_queue) > 0:
+            active_assignments[doctor_id] = user_queue.popleft()
+        user = active_assignments.get(doctor_id)
+    if user is not None:
         # display phone number, values, and triage options (including exit, re-queuing user)
-        return render_template('triage.html', values=session['user_vals'], phonenumber=session['user_uuid'])
+        return render_template('triage.html', values=user.values, phonenumber=user.uuid)
     else:
         # TODO: continuously re-check every few seconds
         return render_template('no_users_triage.html')
@@ -69,107 +124,176 @@ def triaging():
 @application.route('/sms', methods=['POST'])
 def sms():
     phone_number = request.values.get('From', None)
-    message_body = request.values.get('Body', None).strip()
-    # if user texts 'RESTART', remove them from user model repo
-    if message_body.upper() == 'RESTART':
-        user_model_repo.delete(phone_number)
+    # Body may be missing (e.g. a media-only message)
+    message_body = (request.values.get('Body', None) or '').strip()
+    # the repo and user_queue are shared with the triage pages, so update them together
+    with lock:
+        # if user texts 'RESTART', remove them from user model repo
+        if is_restart_message(message_body):
+            user_model_repo.delete(phone_number)
+        response, cont = user_model_repo.get_response(phone_number, message_body)
+        user = user_model_repo.users[phone_number]
+        # start fetching nearby hospitals once the zip code is known (picked up in get_user_instructions)
+        if 'zip_code' in user.values and user.hospitals_future is None:
+            user.hospitals_future = hospital_prefetch_executor.submit(triage.get_hospital_records_within_distance,
+                                                                      user.values['zip_code'], zip_code_radius)
+        # queue user once their info has been fully collected
+        if not cont:
+            user_queue.append(user)
     resp = MessagingResponse()
-    response, cont = user_model_repo.get_response(phone_number, message_body)
     resp.message(response)
-    # queue user once their info has been fully collected
-    if not cont:
-        user_queue.append(user_model_repo.users[phone_number])
     return str(resp)
 
 # page after the patient has been triaged 
 @application.route('/verdict', methods=['POST'])
 def verdict():
-    # clear the session
-    session['user_uuid'] = None
-    session['user_vals'] = None
-
     triage_code = request.values.get('triages', None)
     user_number = request.values.get('phonenumber', None)
     # TODO: make these messages easier to customize
 
     triage_instructions, get_hospital_location = get_triage_instructions(triage_code)
-    # if requeued (i.e. doctor serving them did not offer triage option)
-    if triage_instructions is None:
-        # todo: fix edge case of 'awkward rematching' (re-matched with same doctor who chose to requeue you)
-        user_queue.appendleft(user_model_repo.users[user_number])
-    else:
-        # add the user to the to_respond_queue and remove them from the user model repo
-        user = user_model_repo.get_or_create(user_number)
-        user.values['phone_number'] = user_number
-        user.values['triage_code'] = triage_code
-        user.values['triage_instructions'] = triage_instructions
-        user.values['get_hospital'] = get_hospital_location
-        with work_available_condition:
-            to_respond_queue.append(user)
-            work_available_condition.notify()
-        user_model_repo.delete(user_number)
+    with lock:
+        # the web app user is done with their assigned patient
+        active_assignments.pop(session.get('doctor_id'), None)
+        # if requeued (i.e. doctor serving them did not offer triage option)
+        if triage_instructions is None:
+            # todo: fix edge case of 'awkward rematching' (re-matched with same doctor who chose to requeue you)
+            user_queue.appendleft(user_model_repo.users[user_number])
+        else:
+            # add the user to the to_respond_queue and remove them from the user model repo
+            user = user_model_repo.get_or_create(user_number)
+            user.values['phone_number'] = user_number
+            user.values['triage_code'] = triage_code
+            user.values['triage_instructions'] = triage_instructions
+            user.values['get_hospital'] = get_hospital_location
+            to_respond_queue.put(user)
+            user_model_repo.delete(user_number)
     return render_template('verdict.html')
 
 def get_triage_instructions(triage_code):
-    # TODO: improve response messages
-    triage_responses = {
-        "home": ("Stay at home, rest, and take medication as necessary", False),
-        "LEVEL 1": ("Please seek Triage Level 1 assistance; you will be provided with a list of nearby hospitals/clinics:", True),
-        "LEVEL 2": ("Please seek Triage Level 2 assistance; you will be provided with a list of nearby hospitals/clinics:", True),
-        "LEVEL 3": ("Please seek Triage Level 3 assistance; you will be provided with a list of nearby hospitals/clinics:", True),
-        "LEVEL 4": ("Please seek Triage Level 4 assistance; you will be provided with a list of nearby hospitals/clinics:", True),
-        "gettest": ("Please get tested for COVID-19; you will be provided with a list of nearby testing locations:", False),
-        "checkinlater8": ("Please stay put and text back in 8 hours", False),
-        "checkinlater16": ("Please stay put and text back in 16 hours", False),
-        "checkinlater24": ("Please stay put and text back in 24 hours", False),
-    }
-    if triage_code in triage_responses:
-        return triage_responses[triage_code]
+    return triage_responses.get(triage_code, (None, None))
+
+def get_hospital_choice_probabilities(user_zip_code, triage_code, hospitals):
+    key = (user_zip_code, triage_code, tuple(hosp['attributes']['OBJECTID'] for hosp in hospitals),
+           triage.get_hospital_cache_period())
+    # read once and return what was read: another lookup thread may clear the cache at any time
+    probabilities = hospital_choice_cache.get(key)
+    if probabilities is None:
+        if len(hospital_choice_cache) >= 4096:
+            hospital_choice_cache.clear()
+        weights = matching.match_users.get_match_weights(user_zip_code, triage_code, list(hospitals))
+        probabilities = triage.get_hospital_choice_probabilities(hospitals, weights)
+        probabilities.flags.writeable = False  # shared between users
+        hospital_choice_cache[key] = probabilities
+    return probabilities
+
+def get_user_instructions(user):
+    # build the message for a triaged user (may query the hospital APIs)
+    instructions = user.values['triage_instructions']
+    if user.values['get_hospital']:
+        user_zip_code = user.values['zip_code']
+        # wait for the prefetch started in sms() (if any) to land in the hospital cache, but ignore its result:
+        # it may be from an earlier cache period, and a failed prefetch should not use up a retry
+        hospitals_future, user.hospitals_future = user.hospitals_future, None
+        if hospitals_future is not None:
+            hospitals_future.exception()
+        hospitals = triage.get_hospital_records_within_distance(user_zip_code, zip_code_radius)
+        probabilities = get_hospital_choice_probabilities(user_zip_code, user.values['triage_code'], hospitals)
+        # the choice itself stays random per user, so patients are spread across the hospitals
+        selected_hospitals = triage.make_hospital_choice(hospitals, probabilities=probabilities)
+        parts = [instructions, '\n\nPlease choose one of the following care centers:\n ']
+        parts.extend(hospital_message_format.format_map(hosp['attributes']) for hosp in selected_hospitals)
+        instructions = ''.join(parts)
+    return instructions
+
+def forward_users_to_respond(loop, users):
+    # block on to_respond_queue in a daemon thread of our own and hand each user to the dispatcher's loop
+    # (not via asyncio.to_thread: the default executor's threads are joined at exit, hanging shutdown)
+    def run():
+        while True:
+            loop.call_soon_threadsafe(users.put_nowait, to_respond_queue.get())
+
+    return threading.Thread(target=run, daemon=True)
+
+async def send_sms(http_client, phone_number, body):
+    try:
+        r = await http_client.post('/Messages.json', data={'From': twilio_number, 'To': phone_number, 'Body': body})
+        r.raise_for_status()
+    except httpx.HTTPError as he:
+        logger.error('Could not message %s: %s', phone_number, he)
+
+async def respond(http_client, user):
+    # look up hospitals and send the message for one user; the send goes out as soon as
+    # this user's lookup finishes, while other users' lookups are still in flight
+    if not user.values['get_hospital']:
+        # most verdicts (stay home, check in later, ...) are a fixed message: send it without a thread hop
+        await send_sms(http_client, user.values['phone_number'], user.values['triage_instructions'])
+        return
+    for attempt in range(hospital_lookup_attempts):  # perform API calls (may fail)
+        if attempt > 0:
+            # back off exponentially (capped at 30 seconds) rather than hammering a failing API
+            await asyncio.sleep(min(2 ** (attempt - 1), 30))
+        try:
+            instructions = await asyncio.get_running_loop().run_in_executor(hospital_lookup_executor,
+                                                                            get_user_instructions, user)
+            break
+        except ValueError as ve:
+            logger.error('Error: %s (attempt %d of %d)', ve, attempt + 1, hospital_lookup_attempts)
+        except KeyError as ke:
+            logger.exception('Value not found: %s', ke)
+            return
     else:
-        return None, None
+        # give up on the hospital list, but still send the triage advice itself
+        instructions = user.values['triage_instructions']
+    await send_sms(http_client, user.values['phone_number'], instructions)
+
+async def respond_in_task(http_client, user, in_flight):
+    # one user's failure must not affect the others (or stop the dispatcher)
+    try:
+        await respond(http_client, user)
+    except Exception:
+        logger.exception('Could not respond to %s', user.uuid)
+    finally:
+        in_flight.release()
 
-def create_api_query_worker_thread():
-    def do_work():
+async def sms_dispatcher():
+    # a pool of long-lived clients, so connections (and their TLS sessions) are reused across sends;
+    # over HTTP/2 each client multiplexes its sends onto a single connection to api.twilio.com, and
+    # handing sends out round-robin keeps one slow connection from stalling every send
+    # (credentials are set on each client, so the Authorization header is encoded once, not per send)
+    limits = httpx.Limits(max_connections=64, max_keepalive_connections=32,
+                          keepalive_expiry=twilio_keepalive_seconds)
+    async with contextlib.AsyncExitStack() as stack:
+        http_clients = [await stack.enter_async_context(
+                            httpx.AsyncClient(http2=True, base_url=twilio_api_url, limits=limits,
+                                              auth=(twilio_acct_sid, twilio_token)))
+                        for i in range(twilio_client_pool_size)]
+        client_pool = itertools.cycle(http_clients)
+        users = asyncio.Queue()
+        forward_users_to_respond(asyncio.get_running_loop(), users).start()
+        # respond to each user in its own task, so a slow user never holds up the ones queued after them
+        in_flight = asyncio.Semaphore(sms_max_in_flight)
+        tasks = set()
         while True:
-            with work_available_condition:
-                try:
-                    user = to_respond_queue.popleft()
-                    while True:  # perform API calls (may fail)
-                        try:
-                            instructions = user.values['triage_instructions']
-                            if user.values['get_hospital']:
-                                user_zip_code = user.values['zip_code']
-                                hospitals = triage.get_hospital_records_within_distance(user_zip_code, zip_code_radius)
-                                weights = matching.match_users.get_match_weights(user_zip_code, user.values['triage_code'],
-                                                                                 hospitals)
-                                selected_hospitals = triage.make_hospital_choice(hospitals, weights)
-                                instructions += f'\n\nPlease choose one of the following care centers:\n '
-                                for hosp in selected_hospitals:
-                                    instructions += \
-                                                f'{hosp["attributes"]["NAME"]} \n ' + \
-                                                f'{hosp["attributes"]["ADDRESS"]} \n ' + \
-                                                f'{hosp["attributes"]["CITY"]}, ' + \
-                                                f'{hosp["attributes"]["STATE"]}  ' + \
-                                                f'{hosp["attributes"]["ZIP"]}\n\n'
-                            client.messages.create(from_=twilio_number, body=instructions, to=user.values['phone_number'])
-                            break
-                        except ValueError as ve:
-                            print('Error: {}'.format(ve), file=sys.stderr)
-                            time.sleep(1)  # sleep for one second before trying again
-                        except KeyError as ke:
-                            print('Value not found: {}'.format(ke.with_traceback()), file=sys.stderr)
-                            break
-                except:
-                    work_available_condition.wait()
-
-    return threading.Thread(target=do_work, daemon=True)
+            await in_flight.acquire()
+            user = await users.get()
+            task = asyncio.create_task(respond_in_task(next(client_pool), user, in_flight))
+            # keep a reference until the task is done (the loop only holds weak references to tasks)
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+
+def create_sms_dispatcher_thread():
+    def run():
+        asyncio.run(sms_dispatcher())
+
+    return threading.Thread(target=run, daemon=True)
 
 if __name__ == '__main__':
-    api_threads = [create_api_query_worker_thread() for i in range(2)]
-    for thr in api_threads:
-        thr.start()
+    create_sms_dispatcher_thread().start()
 
     if config['flask']['debug'] == True:
         application.run(host=config['flask']['host'], port=int(config['flask']['port']), debug=True)
     else:
-        serve(application, host=config['flask']['host'], port=int(config['flask']['port']))
\ No newline at end of file
+        # more server threads let Twilio webhooks be answered while other requests are in progress
+        serve(application, host=config['flask']['host'], port=int(config['flask']['port']),
+              threads=int(config['flask'].get('threads', 4)))
\ No newline at end of file
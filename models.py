@@ -31,6 +31,8 @@ class UserModel:
         self.uuid = uuid
         self.actions = actions
         self.values = collections.OrderedDict()
+        # future for hospital records fetched ahead of triage (set by the application once the zip code is known)
+        self.hospitals_future = None
         if(logger is None):
             logger = logging.getLogger(str(uuid))
         self.logger = logger
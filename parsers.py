@@ -5,13 +5,15 @@ from models import ResponseModel, Actions
 from builtins import *
 import sys
 
+# use the libyaml-backed loader when PyYAML was built with it (much faster than the pure-Python one)
+yaml_loader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
 def response_model_from_yaml_file(filename):
-    with open(filename, 'r') as f:
-        text = f.read()
-        return response_model_from_yaml_text(text)
+    with open(filename, 'rb') as f:
+        return response_model_from_yaml(yaml.load(f, Loader=yaml_loader))
 
 def response_model_from_yaml_text(text):
-    schema = yaml.safe_load(text)
+    schema = yaml.load(text, Loader=yaml_loader)
     return response_model_from_yaml(schema)
 
 def response_model_from_yaml(yml):
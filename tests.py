@@ -1,5 +1,7 @@
 import unittest
 
+import numpy as np
+
 from geolocation import GeoLocation
 from parsers import *
 from models import *
@@ -104,6 +106,11 @@ class QueryTests(unittest.TestCase):
         self.assertTrue(len(data) > 0)
         self.assertIsNotNone(make_hospital_choice(data))
 
+    def test_get_hospital_info_bounding_box_cached(self):
+        data = get_hospital_records_within_distance('44116', 50)
+        self.assertIsInstance(data, tuple)
+        self.assertIs(get_hospital_records_within_distance('44116', 50), data)
+
     def test_hospital_weighting(self):
         weights = get_match_weights('44116', 'LEVEL 1', test_hospitals)
         self.assertEqual(len(weights), len(test_hospitals))
@@ -111,6 +118,18 @@ class QueryTests(unittest.TestCase):
         self.assertIsNotNone(choices)
         # print(choices)
 
+    def test_hospital_choice_probabilities(self):
+        weights = [h['attributes']['BEDS'] for h in test_hospitals]
+        probabilities = get_hospital_choice_probabilities(test_hospitals, weights)
+        self.assertEqual(len(probabilities), len(test_hospitals))
+        self.assertAlmostEqual(np.sum(probabilities), 1.0)
+
+        np.random.seed(0)
+        from_weights = make_hospital_choice(test_hospitals, weights)
+        np.random.seed(0)
+        from_probabilities = make_hospital_choice(test_hospitals, probabilities=probabilities)
+        self.assertEqual(from_weights, from_probabilities)
+
     def test_geolocation(self):
         loc1 = GeoLocation.from_degrees(26.062951, -80.238853)
         loc2 = GeoLocation.from_radians(loc1.rad_lat, loc1.rad_lon)
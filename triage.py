@@ -1,3 +1,6 @@
+import functools
+import time
+
 import requests
 import numpy as np
 
@@ -5,6 +8,10 @@ from geolocation import GeoLocation
 from matching.util_functions.extra_functions import get_user_long_lat
 
 
+# hospital lookups are cached for at most this many seconds
+hospital_cache_seconds = 3600
+
+
 def chunker(seq, size):
     return (seq[pos:pos + size] for pos in range(0, len(seq), size))
 
@@ -42,8 +49,33 @@ def get_hospital_records_in_zip_codes(all_zip_codes):
 
 '''
 Get hospitals within distance of zip code
+
+Results are cached (as an immutable tuple) and refreshed every hospital_cache_seconds
 '''
 def get_hospital_records_within_distance(zip_code, distance_in_kilometers):
+    return get_cached_hospital_records_within_distance(zip_code, distance_in_kilometers,
+                                                       get_hospital_cache_period())
+
+
+'''
+Current cache period; part of the key of anything cached from hospital records, so that it expires with them
+'''
+def get_hospital_cache_period():
+    return int(time.time() // hospital_cache_seconds)
+
+
+'''
+Cached lookup; cache_period is part of the key so that entries expire when it changes
+'''
+@functools.lru_cache(maxsize=4096)
+def get_cached_hospital_records_within_distance(zip_code, distance_in_kilometers, cache_period):
+    return tuple(query_hospital_records_within_distance(zip_code, distance_in_kilometers))
+
+
+'''
+Query hospitals within distance of zip code (uncached)
+'''
+def query_hospital_records_within_distance(zip_code, distance_in_kilometers):
     url = 'https://services1.arcgis.com/Hp6G80Pky0om7QvQ/arcgis/rest/services/Hospitals_1/FeatureServer/0/query'
     lon, lat = get_user_long_lat(zip_code)
     loc = GeoLocation.from_degrees(lat, lon)
@@ -61,20 +93,29 @@ def get_hospital_records_within_distance(zip_code, distance_in_kilometers):
 
 
 '''
-Make a hospital choice based on number of beds, randomly chooses from the list
-
-Input data from get_hospital_records_in_zip_codes (filtered for appropriate care level)
+Get the probability of choosing each hospital, from its weight (or its number of beds if no weights are given)
 '''
-def make_hospital_choice(hospitals, weights=None, N=3):
+def get_hospital_choice_probabilities(hospitals, weights=None):
     if weights is None:
         weights = [max(h['attributes']['BEDS'], 0) for h in hospitals]
     else:
         weights = weights + np.abs(np.minimum(np.min(weights), 0))
-    weights = np.array(weights) / np.sum(weights)
+    return np.array(weights) / np.sum(weights)
+
+
+'''
+Make a hospital choice based on number of beds, randomly chooses from the list
+
+Input data from get_hospital_records_in_zip_codes (filtered for appropriate care level)
+Probabilities from get_hospital_choice_probabilities may be passed instead of weights (e.g. if cached)
+'''
+def make_hospital_choice(hospitals, weights=None, N=3, probabilities=None):
+    if probabilities is None:
+        probabilities = get_hospital_choice_probabilities(hospitals, weights)
     try:
-        idxs = np.random.choice(list(range(len(hospitals))), N, p=weights, replace=False)
+        idxs = np.random.choice(list(range(len(hospitals))), N, p=probabilities, replace=False)
     except:
         idxs = list(range(len(hospitals)))
-    wh = [(weights[idx], hospitals[idx]) for idx in idxs]
+    wh = [(probabilities[idx], hospitals[idx]) for idx in idxs]
     return [h for w,h in sorted(wh, key=lambda x: x[0])]
 